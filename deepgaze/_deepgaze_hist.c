@@ -0,0 +1,426 @@
+/*
+ * The MIT License (MIT)
+ * Copyright (c) 2016 Massimiliano Patacchiola
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+ * MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+ * CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+ * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ *
+ * C kernels used by color_classification.py
+ * The AVX2 and AVX-512 versions of the kernels are selected at runtime if the CPU
+ * supports them, otherwise the portable version is used.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#if (defined(__GNUC__) || defined(__clang__)) && (defined(__x86_64__) || defined(__i386__))
+#define DEEPGAZE_X86 1
+#include <immintrin.h>
+#endif
+
+#include <stdint.h>
+#include <string.h>
+
+/* Number of bins processed at once, a block of the image histogram
+ * stays in cache while it is compared with all the models */
+#define BLOCK_SIZE 16384
+
+/* Smallest number of elements in the models matrix for which the intersection
+ * is split across threads, if the extension has been compiled with OpenMP.
+ * OpenMP is not enabled by default, libgomp hangs in the children forked by a
+ * process that already used its threads (see setup.py) */
+#define PARALLEL_MIN_SIZE (1 << 20)
+
+/* Number of private histograms used by the AVX-512 binning, one for each lane */
+#define LANES 16
+
+static int has_avx2 = 0;
+static int has_avx512 = 0;
+
+/* Sum of the bin-wise minimum between two float histograms */
+static double intersect_portable(const float *model, const float *image, Py_ssize_t size)
+{
+    float acc_0 = 0.0f, acc_1 = 0.0f, acc_2 = 0.0f, acc_3 = 0.0f;
+    Py_ssize_t j = 0;
+    for (; j + 4 <= size; j += 4) {
+        acc_0 += model[j] < image[j] ? model[j] : image[j];
+        acc_1 += model[j + 1] < image[j + 1] ? model[j + 1] : image[j + 1];
+        acc_2 += model[j + 2] < image[j + 2] ? model[j + 2] : image[j + 2];
+        acc_3 += model[j + 3] < image[j + 3] ? model[j + 3] : image[j + 3];
+    }
+    for (; j < size; j++) acc_0 += model[j] < image[j] ? model[j] : image[j];
+    return (double)acc_0 + (double)acc_1 + (double)acc_2 + (double)acc_3;
+}
+
+#ifdef DEEPGAZE_X86
+/* Same as intersect_portable, four accumulators of 8 floats hide the latency of the add */
+__attribute__((target("avx2")))
+static double intersect_avx2(const float *model, const float *image, Py_ssize_t size)
+{
+    __m256 acc_0 = _mm256_setzero_ps();
+    __m256 acc_1 = _mm256_setzero_ps();
+    __m256 acc_2 = _mm256_setzero_ps();
+    __m256 acc_3 = _mm256_setzero_ps();
+    __m128 acc;
+    double total;
+    Py_ssize_t j = 0;
+    for (; j + 32 <= size; j += 32) {
+        acc_0 = _mm256_add_ps(acc_0, _mm256_min_ps(_mm256_loadu_ps(model + j), _mm256_loadu_ps(image + j)));
+        acc_1 = _mm256_add_ps(acc_1, _mm256_min_ps(_mm256_loadu_ps(model + j + 8), _mm256_loadu_ps(image + j + 8)));
+        acc_2 = _mm256_add_ps(acc_2, _mm256_min_ps(_mm256_loadu_ps(model + j + 16), _mm256_loadu_ps(image + j + 16)));
+        acc_3 = _mm256_add_ps(acc_3, _mm256_min_ps(_mm256_loadu_ps(model + j + 24), _mm256_loadu_ps(image + j + 24)));
+    }
+    for (; j + 8 <= size; j += 8)
+        acc_0 = _mm256_add_ps(acc_0, _mm256_min_ps(_mm256_loadu_ps(model + j), _mm256_loadu_ps(image + j)));
+    acc_0 = _mm256_add_ps(_mm256_add_ps(acc_0, acc_1), _mm256_add_ps(acc_2, acc_3));
+    acc = _mm_add_ps(_mm256_castps256_ps128(acc_0), _mm256_extractf128_ps(acc_0, 1));
+    acc = _mm_hadd_ps(acc, acc);
+    acc = _mm_hadd_ps(acc, acc);
+    total = _mm_cvtss_f32(acc);
+    for (; j < size; j++) total += model[j] < image[j] ? model[j] : image[j];
+    return total;
+}
+#endif
+
+static double intersect(const float *model, const float *image, Py_ssize_t size)
+{
+#ifdef DEEPGAZE_X86
+    if (has_avx2) return intersect_avx2(model, image, size);
+#endif
+    return intersect_portable(model, image, size);
+}
+
+/* Add to hist the counts of an uint8 frame with interleaved channels. The bin of a pixel is
+ * the sum over the channels of table[c * 256 + value], the table contains the bin of each
+ * value already multiplied by the stride of the channel, or size if the value is out of range.
+ * The pixels out of range are counted in hist[size]. */
+static void hist_uint8_portable(const uint8_t *frame, Py_ssize_t total_pixels, int total_channels,
+                                const int32_t *table, uint32_t size, int32_t *hist)
+{
+    Py_ssize_t j;
+    uint32_t index;
+    int c;
+    for (j = 0; j < total_pixels; j++, frame += total_channels) {
+        index = 0;
+        for (c = 0; c < total_channels; c++) index += (uint32_t)table[c * 256 + frame[c]];
+        hist[index < size ? index : size]++;
+    }
+}
+
+#ifdef DEEPGAZE_X86
+/* Same as hist_uint8_portable, 16 pixels are binned at once with a gather on the table.
+ * If all the channels cover the range [0, 256] the gather is replaced by the multiply-shift
+ * ((value * bins[c]) >> 8) * strides[c], with the bins of the unused channels set to zero.
+ * Every lane updates its own private histogram, in this way the scatter does not have
+ * conflicts and there is no need of conflict detection. The private histograms are
+ * summed at the end. Returns 0 if the private histograms cannot be allocated. */
+__attribute__((target("avx512f")))
+static int hist_uint8_avx512(const uint8_t *frame, Py_ssize_t total_pixels, int total_channels,
+                             const int32_t *table, const int32_t *bins, const int32_t *strides,
+                             uint32_t size, int32_t *hist)
+{
+    /* The private histograms are one cache line apart from a power of two,
+     * otherwise with 2^k bins the lanes compete for the same cache sets */
+    const Py_ssize_t private_size = (Py_ssize_t)size + LANES;
+    const __m512i lane = _mm512_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15);
+    const __m512i byte_mask = _mm512_set1_epi32(0xFF);
+    const __m512i one = _mm512_set1_epi32(1);
+    const __m512i out_of_range = _mm512_set1_epi32((int)size);
+    /* Offset of the 16 pixels in the frame, and of the 16 private histograms */
+    const __m512i pixel_offset = _mm512_mullo_epi32(lane, _mm512_set1_epi32(total_channels));
+    const __m512i lane_offset = _mm512_mullo_epi32(lane, _mm512_set1_epi32((int)private_size));
+    int32_t *private_hist;
+    Py_ssize_t j = 0, k;
+    int c, l;
+
+    private_hist = (int32_t *)PyMem_RawCalloc(LANES * private_size, sizeof(int32_t));
+    if (private_hist == NULL) return 0;
+    /* Each gather reads 4 bytes per pixel, the last pixels are left to the scalar loop */
+    for (; (j + LANES - 1) * total_channels + 4 <= total_pixels * total_channels; j += LANES) {
+        __m512i pixel = _mm512_i32gather_epi32(pixel_offset, (const void *)(frame + j * total_channels), 1);
+        __m512i index = _mm512_setzero_si512();
+        for (c = 0; c < total_channels; c++) {
+            __m512i value = _mm512_and_si512(_mm512_srli_epi32(pixel, 8 * c), byte_mask);
+            if (bins != NULL)
+                value = _mm512_mullo_epi32(_mm512_srli_epi32(_mm512_mullo_epi32(value, _mm512_set1_epi32(bins[c])), 8),
+                                           _mm512_set1_epi32(strides[c]));
+            else
+                value = _mm512_i32gather_epi32(value, (const void *)(table + c * 256), 4);
+            index = _mm512_add_epi32(index, value);
+        }
+        index = _mm512_add_epi32(_mm512_min_epu32(index, out_of_range), lane_offset);
+        _mm512_i32scatter_epi32((void *)private_hist, index,
+                                _mm512_add_epi32(_mm512_i32gather_epi32(index, (const void *)private_hist, 4), one), 4);
+    }
+    hist_uint8_portable(frame + j * total_channels, total_pixels - j, total_channels, table, size, hist);
+    for (l = 0; l < LANES; l++)
+        for (k = 0; k <= (Py_ssize_t)size; k++) hist[k] += private_hist[l * private_size + k];
+    PyMem_RawFree(private_hist);
+    return 1;
+}
+#endif
+
+static PyObject *
+hist_uint8(PyObject *self, PyObject *args)
+{
+    Py_buffer frame, table, hist;
+    Py_ssize_t total_pixels, size;
+    int total_channels, done = 0, c;
+    int full_range = 0, has_bins = 0;
+    int32_t bins[4] = {0, 0, 0, 0}, strides[4] = {0, 0, 0, 0};
+
+    if (!PyArg_ParseTuple(args, "y*y*w*ni|p(iiii)(iiii)", &frame, &table, &hist, &total_pixels, &total_channels,
+                          &full_range, &bins[0], &bins[1], &bins[2], &bins[3],
+                          &strides[0], &strides[1], &strides[2], &strides[3]))
+        return NULL;
+    if (full_range) {
+        has_bins = 1;
+        for (c = 0; c < 4; c++)
+            if (bins[c] < 0 || bins[c] > 256 || strides[c] < 0) has_bins = 0;
+    }
+    size = hist.len / (Py_ssize_t)sizeof(int32_t) - 1;
+    if (total_pixels < 0 || total_channels < 1 || total_channels > 4 || size < 1 || size > INT32_MAX
+        || frame.len < total_pixels * total_channels
+        || table.len < (Py_ssize_t)(total_channels * 256 * sizeof(int32_t))) {
+        PyBuffer_Release(&frame);
+        PyBuffer_Release(&table);
+        PyBuffer_Release(&hist);
+        PyErr_SetString(PyExc_ValueError, "[DEEPGAZE] _deepgaze_hist.c: the buffers are smaller than the sizes specified.");
+        return NULL;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    memset(hist.buf, 0, hist.len);
+#ifdef DEEPGAZE_X86
+    /* On small frames summing the private histograms costs more than the binning */
+    if (has_avx512 && total_pixels >= 4 * size)
+        done = hist_uint8_avx512((const uint8_t *)frame.buf, total_pixels, total_channels, (const int32_t *)table.buf,
+                                 has_bins ? bins : NULL, strides, (uint32_t)size, (int32_t *)hist.buf);
+#endif
+    if (!done)
+        hist_uint8_portable((const uint8_t *)frame.buf, total_pixels, total_channels,
+                            (const int32_t *)table.buf, (uint32_t)size, (int32_t *)hist.buf);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&frame);
+    PyBuffer_Release(&table);
+    PyBuffer_Release(&hist);
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+intersect_batch(PyObject *self, PyObject *args)
+{
+    Py_buffer models, image, out;
+    Py_ssize_t total_models, total_bins, start, stop, i;
+    const float *models_ptr, *image_ptr;
+    double *out_ptr;
+
+    if (!PyArg_ParseTuple(args, "y*y*w*nn", &models, &image, &out, &total_models, &total_bins))
+        return NULL;
+    if (total_models < 0 || total_bins < 0
+        || models.len < (Py_ssize_t)(total_models * total_bins * sizeof(float))
+        || image.len < (Py_ssize_t)(total_bins * sizeof(float))
+        || out.len < (Py_ssize_t)(total_models * sizeof(double))) {
+        PyBuffer_Release(&models);
+        PyBuffer_Release(&image);
+        PyBuffer_Release(&out);
+        PyErr_SetString(PyExc_ValueError, "[DEEPGAZE] _deepgaze_hist.c: the buffers are smaller than the sizes specified.");
+        return NULL;
+    }
+    models_ptr = (const float *)models.buf;
+    image_ptr = (const float *)image.buf;
+    out_ptr = (double *)out.buf;
+
+    Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < total_models; i++) out_ptr[i] = 0.0;
+    /* The rows are split across the threads, with a static schedule every thread
+     * gets the same rows in all the blocks and out can be updated without locks */
+#ifdef _OPENMP
+    #pragma omp parallel private(start, stop, i) if (total_models > 1 && total_models * total_bins >= PARALLEL_MIN_SIZE)
+#endif
+    for (start = 0; start < total_bins; start += BLOCK_SIZE) {
+        stop = start + BLOCK_SIZE < total_bins ? start + BLOCK_SIZE : total_bins;
+#ifdef _OPENMP
+        #pragma omp for schedule(static) nowait
+#endif
+        for (i = 0; i < total_models; i++)
+            out_ptr[i] += intersect(models_ptr + i * total_bins + start, image_ptr + start, stop - start);
+    }
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&models);
+    PyBuffer_Release(&image);
+    PyBuffer_Release(&out);
+    Py_RETURN_NONE;
+}
+
+/* Relative margin below the best sum before a model is discarded, the sums of
+ * the blocks are added in a different order in the bound and in the total of a
+ * model, without it a model tied with the best one could be discarded */
+#define PRUNE_TOLERANCE 1e-9
+
+/* The bound shared by the threads searching the best match is read and written
+ * without locks: every value stored is the intersection of a model, a valid lower
+ * bound of the best one, so losing an update only makes the pruning weaker */
+#if defined(__GNUC__) || defined(__clang__)
+#define LOAD_BOUND(pointer, value) __atomic_load((pointer), &(value), __ATOMIC_RELAXED)
+#define STORE_BOUND(pointer, value) __atomic_store((pointer), &(value), __ATOMIC_RELAXED)
+#else
+#define LOAD_BOUND(pointer, value) ((value) = *(volatile double *)(pointer))
+#define STORE_BOUND(pointer, value) (*(volatile double *)(pointer) = (value))
+#endif
+
+static PyObject *
+best_match_intersect(PyObject *self, PyObject *args)
+{
+    Py_buffer models, image, bound;
+    Py_ssize_t total_models, total_bins, total_blocks, total_active, block, start, stop, i, k;
+    Py_ssize_t best_index = -1;
+    double best_sum = 0.0, shared_sum, bound_sum;
+    double *remaining, *running, *bound_ptr;
+    Py_ssize_t *active;
+    const float *models_ptr, *image_ptr;
+
+    if (!PyArg_ParseTuple(args, "y*y*w*nn", &models, &image, &bound, &total_models, &total_bins))
+        return NULL;
+    if (total_models < 1 || total_bins < 0
+        || models.len < (Py_ssize_t)(total_models * total_bins * sizeof(float))
+        || image.len < (Py_ssize_t)(total_bins * sizeof(float))
+        || bound.len < (Py_ssize_t)sizeof(double)) {
+        PyBuffer_Release(&models);
+        PyBuffer_Release(&image);
+        PyBuffer_Release(&bound);
+        PyErr_SetString(PyExc_ValueError, "[DEEPGAZE] _deepgaze_hist.c: the buffers are smaller than the sizes specified.");
+        return NULL;
+    }
+    total_blocks = (total_bins + BLOCK_SIZE - 1) / BLOCK_SIZE;
+    remaining = (double *)PyMem_RawMalloc((total_blocks + 1) * sizeof(double));
+    running = (double *)PyMem_RawMalloc(total_models * sizeof(double));
+    active = (Py_ssize_t *)PyMem_RawMalloc(total_models * sizeof(Py_ssize_t));
+    if (remaining == NULL || running == NULL || active == NULL) {
+        PyMem_RawFree(remaining);
+        PyMem_RawFree(running);
+        PyMem_RawFree(active);
+        PyBuffer_Release(&models);
+        PyBuffer_Release(&image);
+        PyBuffer_Release(&bound);
+        return PyErr_NoMemory();
+    }
+    models_ptr = (const float *)models.buf;
+    image_ptr = (const float *)image.buf;
+    bound_ptr = (double *)bound.buf;
+
+    Py_BEGIN_ALLOW_THREADS
+    /* remaining[block] is the mass of the image from the block to the end, since
+     * min(model, image) <= image it bounds what a model can still add to its sum.
+     * The block sums are computed by the same kernel of the models, the rounding
+     * is monotone and the bound holds for the sums as computed, not only exactly */
+    remaining[total_blocks] = 0.0;
+    for (block = total_blocks - 1; block >= 0; block--) {
+        start = block * BLOCK_SIZE;
+        stop = start + BLOCK_SIZE < total_bins ? start + BLOCK_SIZE : total_bins;
+        remaining[block] = remaining[block + 1] + intersect(image_ptr + start, image_ptr + start, stop - start);
+    }
+    for (i = 0; i < total_models; i++) {
+        running[i] = 0.0;
+        active[i] = i;
+    }
+    total_active = total_models;
+    /* As in intersect_batch every block of the image is compared with all the
+     * models still active, the models are kept in increasing order */
+    for (block = 0; block < total_blocks && total_active > 0; block++) {
+        start = block * BLOCK_SIZE;
+        stop = start + BLOCK_SIZE < total_bins ? start + BLOCK_SIZE : total_bins;
+        if (block > 0) {
+            /* The partial sums only grow, their maximum is a lower bound of the best
+             * sum. The models that cannot reach it, or the bound found by the other
+             * threads, are discarded. All the sums are positive, 0 discards nothing */
+            best_sum = 0.0;
+            for (k = 0; k < total_active; k++)
+                if (running[active[k]] > best_sum) best_sum = running[active[k]];
+            LOAD_BOUND(bound_ptr, shared_sum);
+            if (best_sum > shared_sum) STORE_BOUND(bound_ptr, best_sum);
+            bound_sum = (best_sum > shared_sum ? best_sum : shared_sum) * (1.0 - PRUNE_TOLERANCE);
+            i = 0;
+            for (k = 0; k < total_active; k++)
+                if (running[active[k]] + remaining[block] >= bound_sum) active[i++] = active[k];
+            total_active = i;
+        }
+        for (k = 0; k < total_active; k++)
+            running[active[k]] += intersect(models_ptr + active[k] * total_bins + start, image_ptr + start, stop - start);
+    }
+    /* The first model with the largest sum, as argmax */
+    for (k = 0; k < total_active; k++) {
+        if (best_index < 0 || running[active[k]] > best_sum) {
+            best_index = active[k];
+            best_sum = running[active[k]];
+        }
+    }
+    if (best_index >= 0) {
+        LOAD_BOUND(bound_ptr, shared_sum);
+        if (best_sum > shared_sum) STORE_BOUND(bound_ptr, best_sum);
+    }
+    Py_END_ALLOW_THREADS
+
+    PyMem_RawFree(remaining);
+    PyMem_RawFree(running);
+    PyMem_RawFree(active);
+    PyBuffer_Release(&models);
+    PyBuffer_Release(&image);
+    PyBuffer_Release(&bound);
+    return Py_BuildValue("nd", best_index, best_sum);
+}
+
+static PyMethodDef deepgaze_hist_methods[] = {
+    {"intersect_batch", intersect_batch, METH_VARARGS,
+     "intersect_batch(models, image, out, total_models, total_bins)\n\n"
+     "Write in out (float64) the histogram intersection between the float32 image\n"
+     "histogram and each row of the float32 row-major models matrix."},
+    {"hist_uint8", hist_uint8, METH_VARARGS,
+     "hist_uint8(frame, table, hist, total_pixels, total_channels[, full_range, bins, strides])\n\n"
+     "Write in hist (int32, size + 1 elements) the flattened histogram of a contiguous\n"
+     "uint8 frame with interleaved channels. table (int32, total_channels x 256) contains\n"
+     "the strided bin of each value or size if out of range, the last element of hist\n"
+     "counts the pixels out of range. If full_range is True all the channels cover [0, 256],\n"
+     "bins and strides are two tuples of 4 integers (zero bins for the unused channels)\n"
+     "and the bins are computed with a multiply-shift instead of the table."},
+    {"best_match_intersect", best_match_intersect, METH_VARARGS,
+     "best_match_intersect(models, image, bound, total_models, total_bins)\n\n"
+     "Return a tuple (index, intersection) with the row of the float32 models matrix\n"
+     "that has the largest intersection with the float32 image histogram, the first\n"
+     "one in case of ties. A model is discarded as soon as it cannot reach the best\n"
+     "intersection found or the float64 in bound, which is shared by the threads\n"
+     "searching other rows and is raised to the best intersection found. The index\n"
+     "is -1 if all the models are below bound."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef deepgaze_hist_module = {
+    PyModuleDef_HEAD_INIT, "_deepgaze_hist", NULL, -1, deepgaze_hist_methods
+};
+
+PyMODINIT_FUNC
+PyInit__deepgaze_hist(void)
+{
+    PyObject *module;
+#ifdef _OPENMP
+    int has_openmp = 1;
+#else
+    int has_openmp = 0;
+#endif
+#ifdef DEEPGAZE_X86
+    __builtin_cpu_init();
+    has_avx2 = __builtin_cpu_supports("avx2") != 0;
+    has_avx512 = __builtin_cpu_supports("avx512f") != 0;
+#endif
+    module = PyModule_Create(&deepgaze_hist_module);
+    if (module != NULL && (PyModule_AddIntConstant(module, "HAS_AVX512", has_avx512) < 0
+                           || PyModule_AddIntConstant(module, "HAS_OPENMP", has_openmp) < 0)) {
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
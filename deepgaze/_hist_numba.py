@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+#The MIT License (MIT)
+#Copyright (c) 2016 Massimiliano Patacchiola
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+#CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+#SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+#Numba kernels used by color_classification.py
+#Importing this module raises ImportError if numba is not installed.
+#
+#The kernel is serial by default. The parallel kernel is used only if the
+#environment variable DEEPGAZE_NUMBA_PARALLEL is 1 when the module is imported.
+#Do not enable it if the classifier is used both before and inside a
+#multiprocessing fork pool: with the omp threading layer the forked children
+#are terminated or hang, with the tbb layer the pool hangs on exit. The
+#workqueue layer aborts the process if many Python threads bin frames at
+#the same time. The serial kernel releases the GIL and has none of these limits.
+
+import os
+import numpy as np
+import numba
+from numba import njit, prange
+
+IS_PARALLEL = os.environ.get('DEEPGAZE_NUMBA_PARALLEL') == '1'
+
+def calc_hist_uint8(frame, table, size, parallel=None):
+    """Return the flattened histogram of an 8-bit frame.
+
+    The bin of a pixel is the sum over the channels of table[channel, value],
+    the table contains the bin of each value already multiplied by the stride
+    of the channel, or size if the value is out of range. The histogram is
+    counted in uint16 when the frame has less than 65536 pixels, since no bin
+    can overflow, in this way it takes half of the cache.
+    In the parallel kernel the rows of the frame are split in chunks, every
+    chunk is accumulated in a private histogram by a different thread and the
+    private histograms are summed at the end.
+    @param frame a numpy array of type uint8 and shape (height, width, channels)
+    @param table a numpy array of type int32 and shape (channels, 256)
+    @param size the number of bins of the histogram
+    @param parallel if True the parallel kernel is used, the default is IS_PARALLEL
+    @return an integer numpy array of shape (size) containing the counts
+    """
+    if parallel is None: parallel = IS_PARALLEL
+    height = frame.shape[0]
+    if not parallel:
+        if height * frame.shape[1] < 65536: count_type = np.uint16
+        else: count_type = np.int32
+        #The last bin counts the pixels out of range
+        hist = np.zeros(size + 1, dtype=count_type)
+        _calc_hist_uint8_serial(frame, table, hist)
+        return hist[0:size]
+    n_chunks = max(1, min(numba.get_num_threads(), height))
+    chunk_rows = (height + n_chunks - 1) // n_chunks
+    if chunk_rows * frame.shape[1] < 65536: count_type = np.uint16
+    else: count_type = np.int32
+    #The last bin of the private histograms counts the pixels out of range
+    private_hist = np.zeros((n_chunks, size + 1), dtype=count_type)
+    return _calc_hist_uint8(frame, table, private_hist, chunk_rows)
+
+@njit(nogil=True, cache=True)
+def _calc_hist_uint8_serial(frame, table, hist):
+    height = frame.shape[0]
+    width = frame.shape[1]
+    total_channels = frame.shape[2]
+    size = hist.shape[0] - 1
+    for i in range(height):
+        for j in range(width):
+            index = 0
+            for k in range(total_channels):
+                index += table[k, frame[i, j, k]]
+            hist[min(index, size)] += 1
+
+@njit(parallel=True, cache=True)
+def _calc_hist_uint8(frame, table, private_hist, chunk_rows):
+    height = frame.shape[0]
+    width = frame.shape[1]
+    total_channels = frame.shape[2]
+    n_chunks = private_hist.shape[0]
+    size = private_hist.shape[1] - 1
+    for c in prange(n_chunks):
+        for i in range(c * chunk_rows, min((c + 1) * chunk_rows, height)):
+            for j in range(width):
+                index = 0
+                for k in range(total_channels):
+                    index += table[k, frame[i, j, k]]
+                private_hist[c, min(index, size)] += 1
+    hist = np.zeros(size, dtype=np.int32)
+    for b in prange(size):
+        for c in range(n_chunks):
+            hist[b] += private_hist[c, b]
+    return hist
@@ -11,6 +11,117 @@
 import numpy as np
 import cv2
 import sys
+import os
+import struct
+import weakref
+import zipfile
+import tempfile
+import shutil
+import multiprocessing
+
+#Check if concurrent.futures is available (Python 3 or the futures backport),
+#it is used to split the intersection across threads
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+#Check if numba is installed, it is used to speed up the histogram binning
+try:
+    from deepgaze._hist_numba import calc_hist_uint8
+    IS_NUMBA_INSTALLED = True
+except ImportError:
+    IS_NUMBA_INSTALLED = False
+
+#Check if the C extension has been compiled, it is used to speed up the intersection and the binning
+try:
+    from deepgaze import _deepgaze_hist
+    IS_C_EXTENSION_INSTALLED = True
+except ImportError:
+    IS_C_EXTENSION_INSTALLED = False
+
+#Largest histogram filled by the numba and C kernels, they keep private copies of it
+PRIVATE_HIST_MAX_SIZE = 65536
+
+#Largest number of channels in the frames binned by the numba and C kernels
+KERNEL_MAX_CHANNELS = 4
+
+#Scale used to store the normalised histograms as uint16
+QUANTIZATION_SCALE = 65535
+
+#Number of bins processed at once by the intersection, a block
+#of the image histogram stays in cache while it is compared with all the models
+INTERSECTION_BLOCK_SIZE = 16384
+
+#Relative margin below the best intersection before a model is discarded by the
+#best match search, the bound and the intersection of a model add the same block
+#sums in a different order and a model tied with the best one could be discarded
+PRUNE_TOLERANCE = 1e-9
+
+#Smallest number of elements in the model matrix for which the numpy intersection
+#is split across threads, numpy releases the GIL in np.minimum and np.sum
+PARALLEL_MIN_SIZE = 1 << 20
+
+#Thread pool shared by all the classifiers, created at the first parallel intersection.
+#The process that created it is stored, a forked child does not have its threads
+_thread_pool = None
+_thread_pool_pid = None
+
+try:
+    _total_cpus = multiprocessing.cpu_count()
+except NotImplementedError:
+    _total_cpus = 1
+
+def _returnTotalThreads(total_models, total_bins):
+    """Return the number of threads used to compare an histogram with a model matrix.
+
+    @param total_models the number of rows of the matrix
+    @param total_bins the number of columns of the matrix
+    """
+    if ThreadPoolExecutor is None or total_models * total_bins < PARALLEL_MIN_SIZE: return 1
+    return max(1, min(_total_cpus, total_models))
+
+def _returnThreadPool():
+    """Return the thread pool shared by the classifiers, a new one after a fork."""
+    global _thread_pool, _thread_pool_pid
+    if _thread_pool is None or _thread_pool_pid != os.getpid():
+        _thread_pool = ThreadPoolExecutor(max_workers=_total_cpus)
+        _thread_pool_pid = os.getpid()
+    return _thread_pool
+
+def _returnModelPath(file_path):
+    """Return the path of a model file, with the extension .npz appended if it is missing.
+
+    @param file_path the path given to saveModel or loadModel
+    """
+    file_path = str(file_path)
+    if not file_path.endswith('.npz'): file_path += '.npz'
+    return file_path
+
+def _returnMemoryMap(file_path, member_name):
+    """Return a read-only memory map of an array stored in an uncompressed npz file.
+
+    np.load does not map the members of an npz file, their data starts after
+    the local header of the zip member and the header of the npy format.
+    @param file_path the path of the npz file
+    @param member_name the name of the member, e.g. 'model_matrix.npy'
+    @return a numpy memmap, or None if the member cannot be mapped
+    """
+    with zipfile.ZipFile(file_path) as zip_file:
+        info = zip_file.getinfo(member_name)
+    if info.compress_type != zipfile.ZIP_STORED: return None
+    with open(file_path, 'rb') as npz_file:
+        npz_file.seek(info.header_offset)
+        #The local header is 30 bytes long, followed by the name and the extra field
+        name_length, extra_length = struct.unpack('<HH', npz_file.read(30)[26:30])
+        npz_file.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(npz_file)
+        if version == (1, 0): shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npz_file)
+        else: shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npz_file)
+        offset = npz_file.tell()
+    #Empty files cannot be mapped
+    if fortran_order or dtype.hasobject or int(np.prod(shape)) == 0: return None
+    return np.memmap(file_path, dtype=dtype, mode='r', offset=offset, shape=shape)
 
 class HistogramColorClassifier:
     """Classifier for comparing an image I with a model M. The comparison is based on color
@@ -29,7 +140,7 @@ class HistogramColorClassifier:
     called Histogram Backprojection performs this task efficiently in crowded scenes.
     """
 
-    def __init__(self, channels=[0, 1, 2], hist_size=[10, 10, 10], hist_range=[0, 256, 0, 256, 0, 256], hist_type='BGR'):
+    def __init__(self, channels=[0, 1, 2], hist_size=[10, 10, 10], hist_range=[0, 256, 0, 256, 0, 256], hist_type='BGR', quantize=False, cache_image=False):
         """Init the classifier.
 
         This class has an internal list containing all the models.
@@ -52,13 +163,164 @@ class HistogramColorClassifier:
             BGR: (default) do not convert the input frame
             HSV: convert in HSV represantation
             GRAY: convert in grayscale
+        @param quantize if True the model histograms are stored as uint16, this halves
+            the memory used and the time taken by the intersection method. The values
+            smaller than 1/65535 are lost, use it only when the number of bins is small.
+        @param cache_image if True the histogram of the last image compared is kept,
+            comparing the same array again does not bin it twice. An array refilled
+            in place (e.g. a frame buffer reused by a video loop) is not detected,
+            use it only when the images are never modified after the first comparison.
         """
         self.channels = channels
         self.hist_size = hist_size
         self.hist_range = hist_range
         self.hist_type = hist_type
-        self.model_list = list()
+        self.quantize = quantize
+        self.cache_image = cache_image
         self.name_list = list()
+        #Dictionary name -> index of the model, it avoids the linear search on the name list
+        self.name_index = dict()
+        #The model histograms are stored as the rows of a contiguous matrix,
+        #in this way the intersection with all the models is a single numpy call
+        if quantize: self.model_matrix = np.empty((0, int(np.prod(hist_size))), dtype=np.uint16)
+        else: self.model_matrix = np.empty((0, int(np.prod(hist_size))), dtype=np.float32)
+        #Tuple (weak reference to the last image compared, its histogram), it is
+        #replaced with a single assignment in order to be consistent across threads
+        self._last_image = None
+        #The cv2.compareHist flags are resolved once, OpenCV 2.x stores them in cv2.cv
+        if hasattr(cv2, 'HISTCMP_INTERSECT'):
+            self._method_flags = {'intersection': cv2.HISTCMP_INTERSECT, 'correlation': cv2.HISTCMP_CORREL,
+                                  'chisqr': cv2.HISTCMP_CHISQR, 'bhattacharyya': cv2.HISTCMP_BHATTACHARYYA}
+        elif hasattr(cv2, 'cv') and hasattr(cv2.cv, 'CV_COMP_INTERSECT'):
+            self._method_flags = {'intersection': cv2.cv.CV_COMP_INTERSECT, 'correlation': cv2.cv.CV_COMP_CORREL,
+                                  'chisqr': cv2.cv.CV_COMP_CHISQR, 'bhattacharyya': cv2.cv.CV_COMP_BHATTACHARYYA}
+        else:
+            raise ValueError('[DEEPGAZE] color_classification.py: the OpenCV version ' + str(cv2.__version__) + ' is not supported.')
+        #Kernel used to fill the histograms of 8-bit frames, the C extension
+        #is preferred if it can use AVX-512 or numba is not installed
+        self._binning_kernel = None
+        self._bin_table = None
+        self._bin_multipliers = None
+        if len(set(channels)) == len(channels) == len(hist_size) == len(hist_range) // 2 \
+           and max(channels) < KERNEL_MAX_CHANNELS and np.prod(hist_size) <= PRIVATE_HIST_MAX_SIZE:
+            self._bin_table = self._returnBinTable()
+            #On the full [0, 256] range the C kernel can use a multiply-shift instead of the table
+            if all(low == 0 and high == 256 for low, high in zip(hist_range[0::2], hist_range[1::2])):
+                bins = [0] * KERNEL_MAX_CHANNELS
+                strides = [0] * KERNEL_MAX_CHANNELS
+                for i in range(len(channels)):
+                    bins[channels[i]] = hist_size[i]
+                    strides[channels[i]] = int(np.prod(hist_size[i+1:]))
+                self._bin_multipliers = (tuple(bins), tuple(strides))
+            if IS_C_EXTENSION_INSTALLED and (_deepgaze_hist.HAS_AVX512 or not IS_NUMBA_INSTALLED): self._binning_kernel = 'c'
+            elif IS_NUMBA_INSTALLED: self._binning_kernel = 'numba'
+
+    def _returnBinTable(self):
+        """Return the table used by the kernels to find the bin of an 8-bit value.
+
+        The element [c, v] is the bin of the value v in the channel c multiplied
+        by the stride of the channel in the flattened histogram, the channels that
+        are not used are zero. The values out of range are set to the size of the
+        histogram. The bins are the same used by cv2.calcHist for 8-bit images.
+        @return a numpy array of type int32 and shape (KERNEL_MAX_CHANNELS, 256)
+        """
+        total_bins = int(np.prod(self.hist_size))
+        bin_table = np.zeros((KERNEL_MAX_CHANNELS, 256), dtype=np.int32)
+        values = np.arange(256)
+        stride = 1
+        for i in reversed(range(len(self.channels))):
+            low, high = self.hist_range[2*i], self.hist_range[2*i+1]
+            scale = self.hist_size[i] / (float(high) - float(low))
+            bins = np.clip(np.floor(values * scale - scale * low), 0, self.hist_size[i] - 1).astype(np.int32)
+            bin_table[self.channels[i]] = np.where((values >= low) & (values < high), bins * stride, total_bins)
+            stride *= self.hist_size[i]
+        return bin_table
+
+    @property
+    def model_list(self):
+        """List containing the histogram of each model.
+
+        The elements are views on the rows of the internal model matrix,
+        or float32 copies of the rows if the matrix is quantized.
+        """
+        if self.quantize: return [self._returnModelHistogram(i) for i in range(len(self.name_list))]
+        return list(self.model_matrix)
+
+    def _returnModelHistogram(self, index):
+        """Return the float32 histogram of the model stored at the index.
+
+        @param index the index of the model in the internal matrix
+        """
+        if self.quantize: return self.model_matrix[index] * np.float32(1.0 / QUANTIZATION_SCALE)
+        return self.model_matrix[index]
+
+    def _quantizeHistogram(self, hist):
+        """Return the histogram with the same type of the internal matrix.
+
+        @param hist a normalised float32 histogram, it is not modified
+        """
+        if not self.quantize: return hist
+        #The product is the only temporary, it is rounded in place
+        scaled_hist = hist * np.float32(QUANTIZATION_SCALE)
+        np.rint(scaled_hist, out=scaled_hist)
+        return scaled_hist.astype(np.uint16)
+
+    def _returnImageHistogram(self, image):
+        """Return the histogram of the image to compare with the models.
+
+        If cache_image is True the histogram of the last image is kept, comparing
+        the same array again (e.g. returnBestMatchIndex followed by returnBestMatchName)
+        does not convert and bin it twice. The array is identified by a weak
+        reference, an image modified in place is not detected.
+        @param image the image to compare
+        @return the normalised float32 histogram of the image
+        """
+        if not self.cache_image: return self._returnHistogram(image)
+        last_image = self._last_image
+        if last_image is not None and last_image[0]() is image: return last_image[1]
+        image_hist = self._returnHistogram(image)
+        try:
+            self._last_image = (weakref.ref(image), image_hist)
+        except TypeError:
+            self._last_image = None
+        return image_hist
+
+    def _returnHistogram(self, frame):
+        """Return the flattened histogram of a BGR frame.
+
+        The histogram is normalised in order to sum up to 1, in this
+        way the intersection of an histogram with itself is 1.
+        @param frame the BGR frame to use
+        @return a float32 numpy array containing the histogram
+        """
+        if(self.hist_type=='HSV'): frame = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+        elif(self.hist_type=='GRAY'): frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        elif(self.hist_type=='RGB'): frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if frame.ndim == 2: total_channels = 1
+        else: total_channels = frame.shape[2]
+        #Single channel frames are binned faster by cv2.calcHist
+        use_kernel = self._binning_kernel is not None and frame.dtype == np.uint8 \
+                     and max(self.channels) < total_channels <= KERNEL_MAX_CHANNELS and total_channels > 1
+        if use_kernel and self._binning_kernel == 'c':
+            frame = np.ascontiguousarray(frame)
+            #The last element counts the pixels out of range
+            hist = np.empty(self.model_matrix.shape[1] + 1, dtype=np.int32)
+            if self._bin_multipliers is None:
+                _deepgaze_hist.hist_uint8(frame, self._bin_table, hist, frame.shape[0] * frame.shape[1], total_channels)
+            else:
+                _deepgaze_hist.hist_uint8(frame, self._bin_table, hist, frame.shape[0] * frame.shape[1], total_channels,
+                                          True, self._bin_multipliers[0], self._bin_multipliers[1])
+            hist = hist[0:-1]
+        elif use_kernel and self._binning_kernel == 'numba':
+            frame = frame.reshape(frame.shape[0], frame.shape[1], total_channels)
+            hist = calc_hist_uint8(frame, self._bin_table[0:total_channels], self.model_matrix.shape[1])
+        else:
+            hist = cv2.calcHist([frame], self.channels, None, self.hist_size, self.hist_range)
+        #cv2.calcHist returns a contiguous float32 array, it is flattened and normalised without copies
+        hist = hist.ravel().astype(np.float32, copy=False)
+        hist_sum = hist.sum()
+        if hist_sum > 0: hist *= 1.0 / hist_sum
+        return hist
 
     def addModelHistogram(self, model_frame, name=''):
         """Add the histogram to internal container. If the name of the object
@@ -69,20 +331,56 @@ class HistogramColorClassifier:
         @param name a string representing the name of the model.
             If nothing is specified then the name will be the index of the element.
         """
-        if(self.hist_type=='HSV'): model_frame = cv2.cvtColor(model_frame, cv2.COLOR_BGR2HSV)
-        elif(self.hist_type=='GRAY'): model_frame = cv2.cvtColor(model_frame, cv2.COLOR_BGR2GRAY)
-        elif(self.hist_type=='RGB'): model_frame = cv2.cvtColor(model_frame, cv2.COLOR_BGR2RGB)
-        hist = cv2.calcHist([model_frame], self.channels, None, self.hist_size, self.hist_range)
-        hist = cv2.normalize(hist, hist).flatten()
-        if name == '': name = str(len(self.model_list))
-        if name not in self.name_list:
-            self.model_list.append(hist)
+        hist = self._quantizeHistogram(self._returnHistogram(model_frame))
+        if name == '': name = str(len(self.name_list))
+        if name not in self.name_index:
+            self.model_matrix = np.vstack((self.model_matrix, hist[np.newaxis, :]))
+            self.name_index[name] = len(self.name_list)
             self.name_list.append(name)
         else:
-            for i in range(len(self.name_list)):
-                if self.name_list[i] == name:
-                    self.model_list[i] = hist
-                    break
+            self._setModelMatrixWriteable()
+            self.model_matrix[self.name_index[name]] = hist
+
+    def addModelHistogramList(self, model_frame_list, name_list=None):
+        """Add the histograms of many frames to the internal container.
+
+        It gives the same result of calling addModelHistogram on each frame,
+        but the new rows are stacked on the model matrix only once.
+        @param model_frame_list a list containing the frames to add to the model
+        @param name_list a list of strings containing the name of each model.
+            If nothing is specified then the name will be the index of the element.
+        """
+        if name_list is None: name_list = [''] * len(model_frame_list)
+        if len(name_list) != len(model_frame_list):
+            raise ValueError('[DEEPGAZE] color_classification.py: the name list has ' + str(len(name_list)) +
+                             ' elements but there are ' + str(len(model_frame_list)) + ' frames.')
+        hist_matrix = np.empty((len(model_frame_list), self.model_matrix.shape[1]), dtype=self.model_matrix.dtype)
+        total_models = len(self.name_list)
+        new_name_list = list()
+        new_name_index = dict()
+        replaced_hist = dict()
+        for model_frame, name in zip(model_frame_list, name_list):
+            if name == '': name = str(total_models + len(new_name_list))
+            hist = self._quantizeHistogram(self._returnHistogram(model_frame))
+            if name in self.name_index:
+                replaced_hist[self.name_index[name]] = hist
+            elif name in new_name_index:
+                hist_matrix[new_name_index[name]] = hist
+            else:
+                hist_matrix[len(new_name_list)] = hist
+                new_name_index[name] = len(new_name_list)
+                new_name_list.append(name)
+        #The classifier is modified only when all the frames have been binned,
+        #if one of them raises an exception the models are left unchanged
+        model_matrix = np.vstack((self.model_matrix, hist_matrix[0:len(new_name_list)]))
+        for index, hist in replaced_hist.items(): model_matrix[index] = hist
+        self.model_matrix = model_matrix
+        for name, index in new_name_index.items(): self.name_index[name] = total_models + index
+        self.name_list.extend(new_name_list)
+
+    def _setModelMatrixWriteable(self):
+        """Copy the model matrix in memory if it is read-only, e.g. mapped by loadModel."""
+        if not self.model_matrix.flags.writeable: self.model_matrix = np.array(self.model_matrix)
 
     def removeModelHistogramByName(self, name):
         """Remove the specific model using the name as index.
@@ -90,13 +388,24 @@ class HistogramColorClassifier:
         @param: name the index of the element to remove
         @return: True if the object has been deleted, otherwise False.
         """
-        if name not in self.name_list:
+        index = self.name_index.pop(name, None)
+        if index is None:
             return False
-        for i in range(len(self.name_list)):
-            if self.name_list[i] == name:
-                del self.name_list[i]
-                del self.model_list[i]
-                return True
+        del self.name_list[index]
+        self.model_matrix = np.delete(self.model_matrix, index, axis=0)
+        #The models after the removed one are shifted back by one
+        for i in range(index, len(self.name_list)):
+            self.name_index[self.name_list[i]] = i
+        return True
+
+    def _returnMethodFlag(self, method):
+        """Return the cv2.compareHist flag associated to a comparison method.
+
+        @param method the comparison method
+        """
+        if method not in self._method_flags:
+            raise ValueError('[DEEPGAZE] color_classification.py: the method specified ' + str(method) + ' is not supported.')
+        return self._method_flags[method]
 
     def returnHistogramComparison(self, hist_1, hist_2, method='intersection'):
         """Return the comparison value of two histograms.
@@ -107,29 +416,141 @@ class HistogramColorClassifier:
         @param method the comparison method.
             intersection: (default) the histogram intersection (Swain, Ballard)
         """
-        if cv2.__version__.split(".")[0] == '3':
-            if(method=="intersection"):
-                comparison = cv2.compareHist(hist_1, hist_2, cv2.HISTCMP_INTERSECT)
-            elif(method=="correlation"):
-                comparison = cv2.compareHist(hist_1, hist_2, cv2.HISTCMP_CORREL)
-            elif(method=="chisqr"):
-                comparison = cv2.compareHist(hist_1, hist_2, cv2.HISTCMP_CHISQR)
-            elif(method=="bhattacharyya"):
-                comparison = cv2.compareHist(hist_1, hist_2, cv2.HISTCMP_BHATTACHARYYA)
-            else:
-                raise ValueError('[DEEPGAZE] color_classification.py: the method specified ' + str(method) + ' is not supported.')
-        else:
-            if(method=="intersection"):
-                comparison = cv2.compareHist(hist_1, hist_2, cv2.cv.CV_COMP_INTERSECT)
-            elif(method=="correlation"):
-                comparison = cv2.compareHist(hist_1, hist_2, cv2.cv.CV_COMP_CORREL)
-            elif(method=="chisqr"):
-                comparison = cv2.compareHist(hist_1, hist_2, cv2.cv.CV_COMP_CHISQR)
-            elif(method=="bhattacharyya"):
-                comparison = cv2.compareHist(hist_1, hist_2, cv2.cv.CV_COMP_BHATTACHARYYA)
-            else:
-                raise ValueError('[DEEPGAZE] color_classification.py: the method specified ' + str(method) + ' is not supported.')
-        return comparison
+        return cv2.compareHist(hist_1, hist_2, self._returnMethodFlag(method))
+
+    def _returnIntersectionArray(self, image_hist):
+        """Return the intersection between an histogram and all the models.
+
+        The bins are processed in blocks of INTERSECTION_BLOCK_SIZE, each block of the
+        image histogram is compared with all the models before moving to the next one.
+        If the C extension is installed it is used for the float32 matrix. On large
+        matrices the models are split across a pool of threads, unless the extension
+        has been compiled with OpenMP and splits them itself.
+        @param image_hist the normalised float32 histogram of the image
+        @return a float64 numpy array containing the intersection with each model
+        """
+        total_models, total_bins = self.model_matrix.shape
+        image_hist = self._quantizeHistogram(image_hist)
+        if IS_C_EXTENSION_INSTALLED and not self.quantize and _deepgaze_hist.HAS_OPENMP: total_threads = 1
+        else: total_threads = _returnTotalThreads(total_models, total_bins)
+        if total_threads < 2:
+            return self._returnIntersectionRows(image_hist, 0, total_models)
+        #Every thread compares the image with a contiguous chunk of rows
+        thread_pool = _returnThreadPool()
+        bounds = np.linspace(0, total_models, total_threads + 1).astype(int)
+        futures = [thread_pool.submit(self._returnIntersectionRows, image_hist, start, stop)
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+        return np.concatenate([future.result() for future in futures])
+
+    def _returnIntersectionRows(self, image_hist, start_row, stop_row):
+        """Return the intersection between an histogram and a range of models.
+
+        The C extension is used for the float32 matrix if it is installed.
+        @param image_hist the histogram of the image, with the same type of the model matrix
+        @param start_row index of the first model
+        @param stop_row index after the last model
+        @return a float64 numpy array containing the intersection with each model in the range
+        """
+        model_matrix = self.model_matrix[start_row:stop_row]
+        total_models, total_bins = model_matrix.shape
+        if IS_C_EXTENSION_INSTALLED and not self.quantize:
+            intersection_array = np.empty(total_models, dtype=np.float64)
+            _deepgaze_hist.intersect_batch(model_matrix, image_hist, intersection_array, total_models, total_bins)
+            return intersection_array
+        block_size = min(INTERSECTION_BLOCK_SIZE, total_bins)
+        #The buffer for the minimum is a single block, it is allocated at every call
+        #in this way many threads can compare images with the same classifier
+        buffer = np.empty((total_models, block_size), dtype=model_matrix.dtype)
+        if self.quantize: sum_type = np.uint64
+        else: sum_type = np.float64
+        intersection_array = np.zeros(total_models, dtype=sum_type)
+        for start in range(0, total_bins, block_size):
+            stop = min(start + block_size, total_bins)
+            block_buffer = buffer[:, 0:stop-start]
+            np.minimum(model_matrix[:, start:stop], image_hist[start:stop], out=block_buffer)
+            intersection_array += block_buffer.sum(axis=1, dtype=sum_type)
+        if self.quantize: return intersection_array / float(QUANTIZATION_SCALE)
+        return intersection_array
+
+    def _returnBestIntersectionIndex(self, image_hist):
+        """Return the index of the model with the largest intersection with an histogram.
+
+        The intersection with the bins left is at most the sum of those bins in the
+        image histogram, the models that cannot reach the best partial intersection
+        anymore are discarded before comparing the next block of bins.
+        On large matrices the models are split across the pool of threads, the
+        chunks share the best intersection found so far and their results are merged.
+        In case of ties the first model is returned, as in argmax.
+        @param image_hist the normalised float32 histogram of the image
+        @return the index of the best matching model
+        """
+        total_models, total_bins = self.model_matrix.shape
+        if total_models < 2: return int(self._returnIntersectionArray(image_hist).argmax())
+        image_hist = self._quantizeHistogram(image_hist)
+        #Lower bound of the best intersection, raised by the chunks while they are searched
+        shared_bound = np.zeros(1, dtype=np.float64)
+        total_threads = _returnTotalThreads(total_models, total_bins)
+        if total_threads < 2: return self._returnBestIntersectionRows(image_hist, 0, total_models, shared_bound)[0]
+        thread_pool = _returnThreadPool()
+        bounds = np.linspace(0, total_models, total_threads + 1).astype(int)
+        futures = [thread_pool.submit(self._returnBestIntersectionRows, image_hist, start, stop, shared_bound)
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+        #The chunks are merged in order, a later chunk wins only with a larger intersection.
+        #A chunk has no result if all its models are below the bound of the other chunks
+        best_index, best_intersection = -1, None
+        for future in futures:
+            index, intersection = future.result()
+            if index >= 0 and (best_index < 0 or intersection > best_intersection):
+                best_index, best_intersection = index, intersection
+        return best_index
+
+    def _returnBestIntersectionRows(self, image_hist, start_row, stop_row, shared_bound):
+        """Return the best intersection between an histogram and a range of models.
+
+        @param image_hist the histogram of the image, with the same type of the model matrix
+        @param start_row index of the first model
+        @param stop_row index after the last model, the range contains at least one model
+        @param shared_bound a float64 numpy array with one element, the models below it
+            are discarded and it is raised to the best partial intersection of the range
+        @return a tuple (index of the best model, its intersection), in the quantized
+            case the intersection is the integer sum of the uint16 bins. The index
+            is -1 if all the models are below the bound
+        """
+        model_matrix = self.model_matrix[start_row:stop_row]
+        total_models, total_bins = model_matrix.shape
+        if IS_C_EXTENSION_INSTALLED and not self.quantize:
+            index, intersection = _deepgaze_hist.best_match_intersect(model_matrix, image_hist, shared_bound,
+                                                                      total_models, total_bins)
+            if index < 0: return -1, None
+            return start_row + index, intersection
+        if self.quantize: sum_type = np.uint64
+        else: sum_type = np.float64
+        block_size = min(INTERSECTION_BLOCK_SIZE, total_bins)
+        block_starts = range(0, total_bins, block_size)
+        #remaining_array[k] is the sum of the image histogram from the block k to the end,
+        #the blocks are summed as the blocks of the models
+        remaining_array = np.zeros(len(block_starts) + 1, dtype=sum_type)
+        for k in range(len(block_starts) - 1, -1, -1):
+            start = block_starts[k]
+            remaining_array[k] = remaining_array[k + 1] + image_hist[np.newaxis, start:start+block_size].sum(axis=1, dtype=sum_type)[0]
+        model_index = np.arange(total_models)
+        intersection_array = np.zeros(total_models, dtype=sum_type)
+        for k, start in enumerate(block_starts):
+            stop = min(start + block_size, total_bins)
+            if start > 0:
+                #The partial intersections only grow, their maximum is a lower bound of the best one
+                best_partial = intersection_array.max()
+                if best_partial > shared_bound[0]: shared_bound[0] = best_partial
+                is_candidate = intersection_array + remaining_array[k] >= max(best_partial, shared_bound[0]) * (1.0 - PRUNE_TOLERANCE)
+                if not is_candidate.all():
+                    model_index = model_index[is_candidate]
+                    intersection_array = intersection_array[is_candidate]
+                    if len(model_index) == 0: return -1, None
+            if len(model_index) == total_models: model_block = model_matrix[:, start:stop]
+            else: model_block = model_matrix[model_index, start:stop]
+            intersection_array += np.minimum(model_block, image_hist[start:stop]).sum(axis=1, dtype=sum_type)
+        best = intersection_array.argmax()
+        return start_row + int(model_index[best]), intersection_array[best]
 
     def returnHistogramComparisonArray(self, image, method='intersection'):
         """Return the comparison array between all the model and the input image.
@@ -140,16 +561,12 @@ class HistogramColorClassifier:
             intersection: (default) the histogram intersection (Swain, Ballard)
         @return a numpy array containg the comparison value between each pair image-model
         """
-        if(self.hist_type=='HSV'): image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        elif(self.hist_type=='GRAY'): image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        elif(self.hist_type=='RGB'): image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        comparison_array = np.zeros(len(self.model_list))
-        image_hist = cv2.calcHist([image], self.channels, None, self.hist_size, self.hist_range)
-        image_hist = cv2.normalize(image_hist, image_hist).flatten()
-        counter = 0
-        for model_hist in self.model_list:
-            comparison_array[counter] = self.returnHistogramComparison(image_hist, model_hist, method=method)
-            counter += 1
+        image_hist = self._returnImageHistogram(image)
+        if(method=="intersection"): return self._returnIntersectionArray(image_hist)
+        method_flag = self._returnMethodFlag(method)
+        comparison_array = np.zeros(len(self.name_list))
+        for i in range(len(self.name_list)):
+            comparison_array[i] = cv2.compareHist(image_hist, self._returnModelHistogram(i), method_flag)
         return comparison_array
 
     def returnHistogramComparisonProbability(self, image, method='intersection'):
@@ -165,8 +582,9 @@ class HistogramColorClassifier:
         """
         comparison_array = self.returnHistogramComparisonArray(image=image, method=method)
         #comparison_array[comparison_array < 0] = 0 #Remove negative values
-        comparison_distribution = np.divide(comparison_array, np.sum(comparison_array))
-        return comparison_distribution
+        #The array is not shared, it can be normalised in place
+        comparison_array /= comparison_array.sum()
+        return comparison_array
 
     def returnBestMatchIndex(self, image, method='intersection'):
         """Return the index of the best match between the image and the internal models.
@@ -176,8 +594,9 @@ class HistogramColorClassifier:
             intersection: (default) the histogram intersection (Swain, Ballard)
         @return a numpy array containg the comparison value between each pair image-model
         """
+        if(method=="intersection"): return self._returnBestIntersectionIndex(self._returnImageHistogram(image))
         comparison_array = self.returnHistogramComparisonArray(image, method=method)
-        return np.argmax(comparison_array)
+        return int(comparison_array.argmax())
 
     def returnBestMatchName(self, image, method='intersection'):
         """Return the name of the best match between the image and the internal models.
@@ -187,9 +606,7 @@ class HistogramColorClassifier:
             intersection: (default) the histogram intersection (Swain, Ballard)
         @return a string representing the name of the best matching model
         """
-        comparison_array = self.returnHistogramComparisonArray(image, method=method)
-        arg_max = np.argmax(comparison_array)
-        return self.name_list[arg_max]
+        return self.name_list[self.returnBestMatchIndex(image, method=method)]
 
     def returnNameList(self):
         """Return a list containing all the names stored in the model.
@@ -203,5 +620,65 @@ class HistogramColorClassifier:
 
         @return: an integer representing the number of elements stored
         """
-        return len(self.model_list)
+        return len(self.name_list)
+
+    def saveModel(self, file_path):
+        """Save the models and the parameters of the classifier in a npz file.
+
+        The file is not compressed, in this way loadModel can map the
+        model matrix instead of computing the histograms again. It is written
+        in a temporary file that replaces the old one at the end, the classifiers
+        that have mapped the old file keep reading it.
+        @param file_path the path of the file, the extension .npz is
+            appended if it is missing
+        """
+        for name in self.name_list:
+            if not isinstance(name, str):
+                raise ValueError('[DEEPGAZE] color_classification.py: the name ' + repr(name) + ' is not a string, '
+                                 'only models with string names can be saved.')
+        file_path = _returnModelPath(file_path)
+        file_descriptor, temp_path = tempfile.mkstemp(suffix='.npz', dir=os.path.dirname(os.path.abspath(file_path)))
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                np.savez(temp_file, model_matrix=self.model_matrix, name_list=np.array(self.name_list, dtype=str),
+                         channels=np.array(self.channels), hist_size=np.array(self.hist_size),
+                         hist_range=np.array(self.hist_range), hist_type=np.array(self.hist_type),
+                         quantize=np.array(self.quantize))
+            #mkstemp creates the file readable only by the owner
+            if os.path.exists(file_path): shutil.copymode(file_path, temp_path)
+            else: os.chmod(temp_path, 0o644)
+            #os.replace is not available on Python 2, os.rename replaces the file on POSIX
+            getattr(os, 'replace', os.rename)(temp_path, file_path)
+        except BaseException:
+            if os.path.exists(temp_path): os.remove(temp_path)
+            raise
+
+    @classmethod
+    def loadModel(cls, file_path, mmap=True, cache_image=False):
+        """Return a classifier with the models saved by saveModel.
+
+        @param file_path the path of the npz file, the extension .npz is
+            appended if it is missing
+        @param mmap if True (default) the model matrix is mapped read-only from
+            the file, the processes loading the same file share its pages.
+            The matrix is copied in memory the first time a model is replaced.
+        @param cache_image the cache_image parameter of the classifier
+        @return a HistogramColorClassifier
+        """
+        file_path = _returnModelPath(file_path)
+        with np.load(file_path) as data:
+            classifier = cls(channels=data['channels'].tolist(), hist_size=data['hist_size'].tolist(),
+                             hist_range=data['hist_range'].tolist(), hist_type=str(data['hist_type']),
+                             quantize=bool(data['quantize']), cache_image=cache_image)
+            name_list = [str(name) for name in data['name_list']]
+            model_matrix = None
+            if mmap: model_matrix = _returnMemoryMap(file_path, 'model_matrix.npy')
+            if model_matrix is None: model_matrix = data['model_matrix']
+        if model_matrix.shape != (len(name_list), classifier.model_matrix.shape[1]) \
+           or model_matrix.dtype != classifier.model_matrix.dtype:
+            raise ValueError('[DEEPGAZE] color_classification.py: the model matrix in ' + str(file_path) + ' does not match the parameters.')
+        classifier.model_matrix = model_matrix
+        classifier.name_list = name_list
+        classifier.name_index = dict((name, i) for i, name in enumerate(name_list))
+        return classifier
 
@@ -1,6 +1,50 @@
 #!/usr/bin/env python
 
-from distutils.core import setup
+import os
+from distutils.core import setup, Extension
+from distutils.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsExecError, DistutilsPlatformError
+
+class optional_build_ext(build_ext):
+    """The C extension is optional, deepgaze falls back on numpy if it cannot be compiled.
+
+    The extension is compiled with OpenMP only if the environment variable
+    DEEPGAZE_OPENMP is 1 and the compiler supports it. Do not enable it if the
+    classifier is used both before and inside a multiprocessing fork pool,
+    libgomp hangs in the forked children. Without OpenMP the intersection is
+    split across a Python thread pool, which is recreated after a fork.
+    """
+
+    def run(self):
+        try:
+            build_ext.run(self)
+        except DistutilsPlatformError:
+            print('[DEEPGAZE] setup.py: the C extension has not been compiled.')
+
+    def build_extension(self, ext):
+        if os.environ.get('DEEPGAZE_OPENMP') != '1':
+            try:
+                build_ext.build_extension(self, ext)
+            except (CCompilerError, DistutilsExecError, DistutilsPlatformError):
+                print('[DEEPGAZE] setup.py: the C extension ' + ext.name + ' has not been compiled.')
+            return
+        if self.compiler.compiler_type == 'msvc': openmp_flags = ['/openmp']
+        else: openmp_flags = ['-fopenmp']
+        compile_args = list(ext.extra_compile_args)
+        link_args = list(ext.extra_link_args)
+        try:
+            ext.extra_compile_args = compile_args + openmp_flags
+            ext.extra_link_args = link_args + openmp_flags
+            build_ext.build_extension(self, ext)
+            return
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError):
+            print('[DEEPGAZE] setup.py: OpenMP is not available, compiling ' + ext.name + ' without it.')
+        try:
+            ext.extra_compile_args = compile_args
+            ext.extra_link_args = link_args
+            build_ext.build_extension(self, ext)
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError):
+            print('[DEEPGAZE] setup.py: the C extension ' + ext.name + ' has not been compiled.')
 
 setup(name='deepgaze',
   version='0.1',
@@ -10,6 +54,8 @@ setup(name='deepgaze',
   packages = ['deepgaze'],
   package_data={'deepgaze': ['Readme.md']},
   include_package_data=True,
+  ext_modules=[Extension('deepgaze._deepgaze_hist', ['deepgaze/_deepgaze_hist.c'], extra_compile_args=['-O3'])],
+  cmdclass={'build_ext': optional_build_ext},
   license="The MIT License (MIT)",
   requires = ['numpy', 'cv', 'cv2', 'tensorflow']
  )
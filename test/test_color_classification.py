@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+
+#The MIT License (MIT)
+#Copyright (c) 2016 Massimiliano Patacchiola
+#
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+#MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+#CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+#SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+#Regression tests of the fast paths of color_classification.py, they are compared
+#with cv2.calcHist and with the full intersection array.
+#Run from the root of the repository: python -m unittest discover test
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import cv2
+import deepgaze.color_classification as color_classification
+from deepgaze.color_classification import HistogramColorClassifier
+
+IMAGES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples', 'ex_color_classification_images')
+
+def load_images(name, total):
+    return [cv2.imread(os.path.join(IMAGES_PATH, name % i)) for i in range(1, total + 1)]
+
+class TestBinningKernels(unittest.TestCase):
+    """The numba kernels and the C kernel must give the same counts of cv2.calcHist."""
+
+    configurations = [dict(), dict(hist_size=[32, 32, 32]),
+                      dict(hist_type='HSV', hist_range=[0, 180, 0, 256, 0, 256]),
+                      dict(channels=[0, 1], hist_size=[30, 32], hist_range=[0, 180, 0, 256], hist_type='HSV'),
+                      dict(channels=[2, 0], hist_size=[7, 13], hist_range=[10, 200, 3, 250]),
+                      dict(hist_size=[9, 11, 13], hist_range=[1, 255, 17, 99, 0, 181])]
+
+    def setUp(self):
+        image = cv2.imread(os.path.join(IMAGES_PATH, 'image_2.jpg'))
+        random_frame = np.random.RandomState(0).randint(0, 256, (4, 7, 3)).astype(np.uint8)
+        #The full image is large enough for the AVX-512 kernel, the others use the portable loop
+        self.frames = [image, image[10:200, 33:301], cv2.resize(image, (3, 5)), image[:1, :1], random_frame]
+
+    def _assertKernel(self, kernel):
+        for configuration in self.configurations:
+            classifier = HistogramColorClassifier(**configuration)
+            reference = HistogramColorClassifier(**configuration)
+            reference._binning_kernel = None
+            self.assertIsNotNone(classifier._binning_kernel, configuration)
+            classifier._binning_kernel = kernel
+            for frame in self.frames:
+                hist = classifier._returnHistogram(frame)
+                reference_hist = reference._returnHistogram(frame)
+                self.assertEqual(hist.shape, reference_hist.shape)
+                self.assertTrue(np.array_equal(hist, reference_hist), (kernel, configuration, frame.shape))
+
+    def test_c_kernel(self):
+        if not color_classification.IS_C_EXTENSION_INSTALLED: self.skipTest('the C extension is not compiled')
+        self._assertKernel('c')
+
+    def test_numba_kernel(self):
+        if not color_classification.IS_NUMBA_INSTALLED: self.skipTest('numba is not installed')
+        self._assertKernel('numba')
+
+    def test_numba_parallel_kernel(self):
+        if not color_classification.IS_NUMBA_INSTALLED: self.skipTest('numba is not installed')
+        from deepgaze import _hist_numba
+        is_parallel = _hist_numba.IS_PARALLEL
+        _hist_numba.IS_PARALLEL = not is_parallel
+        try: self._assertKernel('numba')
+        finally: _hist_numba.IS_PARALLEL = is_parallel
+
+class TestBestMatch(unittest.TestCase):
+    """The pruned best match search must return the argmax of the full intersection array."""
+
+    def setUp(self):
+        self.is_c_extension_installed = color_classification.IS_C_EXTENSION_INSTALLED
+        self.total_cpus = color_classification._total_cpus
+
+    def tearDown(self):
+        color_classification.IS_C_EXTENSION_INSTALLED = self.is_c_extension_installed
+        color_classification._total_cpus = self.total_cpus
+
+    def _returnPaths(self):
+        if self.is_c_extension_installed: return [True, False]
+        return [False]
+
+    def test_example_images(self):
+        models = load_images('model_%d.png', 8)
+        images = load_images('image_%d.jpg', 9)
+        for use_c_extension in self._returnPaths():
+            color_classification.IS_C_EXTENSION_INSTALLED = use_c_extension
+            for quantize in [False, True]:
+                for hist_size in [[10, 10, 10], [64, 64, 64]]:
+                    classifier = HistogramColorClassifier(hist_size=hist_size, quantize=quantize)
+                    classifier.addModelHistogramList(models)
+                    #A copy of a model at the end, the first one has to win the tie
+                    classifier.addModelHistogram(models[1], name='copy')
+                    for image in images + models:
+                        expected = int(classifier.returnHistogramComparisonArray(image).argmax())
+                        self.assertEqual(classifier.returnBestMatchIndex(image), expected)
+
+    def test_ties_across_threads(self):
+        random_state = np.random.RandomState(5)
+        total_bins = 64 ** 3
+        for total_threads in [1, 2, 3, 5]:
+            #The matrices are large enough to be split in total_threads chunks
+            color_classification._total_cpus = total_threads
+            for use_c_extension in self._returnPaths():
+                color_classification.IS_C_EXTENSION_INSTALLED = use_c_extension
+                for quantize in [False, True]:
+                    for trial in range(4):
+                        classifier = HistogramColorClassifier(hist_size=[64, 64, 64], quantize=quantize)
+                        total_models = random_state.randint(2, 30)
+                        model_list = list()
+                        for i in range(total_models):
+                            hist = np.zeros(total_bins, dtype=np.float32)
+                            start = random_state.randint(0, total_bins - 30000)
+                            hist[start:start+30000] = random_state.rand(30000)
+                            model_list.append(hist / hist.sum())
+                        image_hist = model_list[random_state.randint(0, total_models)].copy()
+                        for i in random_state.randint(0, total_models, 3): model_list[i] = image_hist.copy()
+                        classifier.model_matrix = np.ascontiguousarray([classifier._quantizeHistogram(hist) for hist in model_list])
+                        classifier.name_list = [str(i) for i in range(total_models)]
+                        expected = int(classifier._returnIntersectionArray(image_hist).argmax())
+                        self.assertEqual(classifier._returnBestIntersectionIndex(image_hist), expected,
+                                         (total_threads, use_c_extension, quantize))
+
+class TestModelList(unittest.TestCase):
+    """addModelHistogramList must give the same models of repeated calls of addModelHistogram."""
+
+    def setUp(self):
+        self.models = load_images('model_%d.png', 8)
+
+    def _assertEqualModels(self, classifier, expected_classifier):
+        self.assertEqual(classifier.model_matrix.dtype, expected_classifier.model_matrix.dtype)
+        self.assertTrue(np.array_equal(classifier.model_matrix, expected_classifier.model_matrix))
+        self.assertEqual(classifier.name_list, expected_classifier.name_list)
+        self.assertEqual(classifier.name_index, expected_classifier.name_index)
+
+    def test_repeated_calls(self):
+        #Names already present, repeated in the list and left to the default
+        name_list = ['a', '', 'a', 'b', '', '0', 'c', 'b']
+        for quantize in [False, True]:
+            classifier = HistogramColorClassifier(quantize=quantize)
+            expected_classifier = HistogramColorClassifier(quantize=quantize)
+            for model in self.models[0:2]:
+                classifier.addModelHistogram(model)
+                expected_classifier.addModelHistogram(model)
+            classifier.addModelHistogramList(self.models, name_list)
+            for model, name in zip(self.models, name_list): expected_classifier.addModelHistogram(model, name)
+            self._assertEqualModels(classifier, expected_classifier)
+            classifier.addModelHistogramList(self.models[::-1])
+            for model in self.models[::-1]: expected_classifier.addModelHistogram(model)
+            self._assertEqualModels(classifier, expected_classifier)
+
+    def test_failed_frame(self):
+        classifier = HistogramColorClassifier()
+        classifier.addModelHistogramList(self.models[0:3], ['a', 'b', 'c'])
+        expected_classifier = HistogramColorClassifier()
+        expected_classifier.addModelHistogramList(self.models[0:3], ['a', 'b', 'c'])
+        #The first frame replaces a model and the second one adds a model before the failure
+        self.assertRaises(Exception, classifier.addModelHistogramList, [self.models[5], self.models[6], None],
+                          ['a', 'd', 'e'])
+        self._assertEqualModels(classifier, expected_classifier)
+
+    def test_length_mismatch(self):
+        classifier = HistogramColorClassifier()
+        self.assertRaises(ValueError, classifier.addModelHistogramList, self.models, ['a', 'b'])
+        self.assertRaises(ValueError, classifier.addModelHistogramList, self.models[0:2], ['a', 'b', 'c'])
+        self.assertEqual(classifier.returnSize(), 0)
+
+    def test_remove_model(self):
+        classifier = HistogramColorClassifier()
+        classifier.addModelHistogramList(self.models)
+        self.assertTrue(classifier.removeModelHistogramByName('3'))
+        self.assertFalse(classifier.removeModelHistogramByName('3'))
+        self.assertEqual(classifier.name_list, ['0', '1', '2', '4', '5', '6', '7'])
+        self.assertEqual(classifier.name_index, dict((name, i) for i, name in enumerate(classifier.name_list)))
+        for name in classifier.name_list:
+            self.assertEqual(classifier.returnBestMatchName(self.models[int(name)]), name)
+        classifier.addModelHistogram(self.models[0], name='5')
+        self.assertEqual(classifier.returnBestMatchName(self.models[0]), '0')
+        self.assertTrue(np.array_equal(classifier.model_matrix[4], classifier.model_matrix[0]))
+
+class TestImageCache(unittest.TestCase):
+    """The histogram of the image is cached only with cache_image=True."""
+
+    def setUp(self):
+        self.models = load_images('model_%d.png', 8)
+
+    def test_default_modified_image(self):
+        classifier = HistogramColorClassifier()
+        classifier.addModelHistogramList(self.models)
+        image = self.models[0].copy()
+        self.assertEqual(classifier.returnBestMatchIndex(image), 0)
+        image[:] = cv2.resize(self.models[1], (image.shape[1], image.shape[0]))
+        self.assertEqual(classifier.returnBestMatchIndex(image), 1)
+
+    def test_cache_image(self):
+        classifier = HistogramColorClassifier(cache_image=True)
+        classifier.addModelHistogramList(self.models)
+        image = self.models[0].copy()
+        image_hist = classifier._returnImageHistogram(image)
+        self.assertIs(classifier._returnImageHistogram(image), image_hist)
+        self.assertEqual(classifier.returnBestMatchIndex(image), 0)
+        #An array with the same content is a different image, its histogram is computed again
+        same_image = image.copy()
+        same_image_hist = classifier._returnImageHistogram(same_image)
+        self.assertIsNot(same_image_hist, image_hist)
+        self.assertTrue(np.array_equal(same_image_hist, image_hist))
+        self.assertIs(classifier._returnImageHistogram(same_image), same_image_hist)
+
+class TestSaveModel(unittest.TestCase):
+    """loadModel must return the classifier given to saveModel."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.models = load_images('model_%d.png', 8)
+        self.images = load_images('image_%d.jpg', 9)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _assertEqualClassifiers(self, classifier, loaded_classifier):
+        self.assertEqual(loaded_classifier.model_matrix.dtype, classifier.model_matrix.dtype)
+        self.assertTrue(np.array_equal(loaded_classifier.model_matrix, classifier.model_matrix))
+        self.assertEqual(loaded_classifier.name_list, classifier.name_list)
+        self.assertEqual(loaded_classifier.name_index, classifier.name_index)
+        for name in ['channels', 'hist_size', 'hist_range', 'hist_type', 'quantize']:
+            self.assertEqual(getattr(loaded_classifier, name), getattr(classifier, name), name)
+
+    def test_round_trip(self):
+        file_path = os.path.join(self.directory, 'model.npz')
+        for quantize in [False, True]:
+            classifier = HistogramColorClassifier(quantize=quantize)
+            classifier.addModelHistogramList(self.models, ['model_' + str(i) for i in range(len(self.models))])
+            classifier.saveModel(file_path)
+            for mmap in [True, False]:
+                loaded_classifier = HistogramColorClassifier.loadModel(file_path, mmap=mmap)
+                self._assertEqualClassifiers(classifier, loaded_classifier)
+                self.assertEqual(isinstance(loaded_classifier.model_matrix, np.memmap), mmap)
+                for image in self.images:
+                    self.assertEqual(loaded_classifier.returnBestMatchName(image), classifier.returnBestMatchName(image))
+
+    def test_replace_mapped_model(self):
+        file_path = os.path.join(self.directory, 'model.npz')
+        classifier = HistogramColorClassifier()
+        classifier.addModelHistogramList(self.models)
+        classifier.saveModel(file_path)
+        with open(file_path, 'rb') as model_file: file_bytes = model_file.read()
+        loaded_classifier = HistogramColorClassifier.loadModel(file_path)
+        self.assertFalse(loaded_classifier.model_matrix.flags.writeable)
+        #The mapped matrix is copied in memory before the row is replaced
+        loaded_classifier.addModelHistogram(self.images[0], name='1')
+        classifier.addModelHistogram(self.images[0], name='1')
+        self.assertTrue(np.array_equal(loaded_classifier.model_matrix, classifier.model_matrix))
+        with open(file_path, 'rb') as model_file: self.assertEqual(model_file.read(), file_bytes)
+
+    def test_save_over_mapped_file(self):
+        file_path = os.path.join(self.directory, 'model.npz')
+        classifier = HistogramColorClassifier()
+        classifier.addModelHistogramList(self.models)
+        classifier.saveModel(file_path)
+        loaded_classifier = HistogramColorClassifier.loadModel(file_path)
+        new_classifier = HistogramColorClassifier()
+        new_classifier.addModelHistogramList(self.images)
+        new_classifier.saveModel(file_path)
+        #The first classifier keeps reading the pages of the replaced file
+        for image in self.images:
+            self.assertEqual(loaded_classifier.returnBestMatchIndex(image), classifier.returnBestMatchIndex(image))
+        self._assertEqualClassifiers(new_classifier, HistogramColorClassifier.loadModel(file_path))
+
+    def test_path_without_extension(self):
+        file_path = os.path.join(self.directory, 'm')
+        classifier = HistogramColorClassifier()
+        classifier.addModelHistogramList(self.models)
+        classifier.saveModel(file_path)
+        self.assertTrue(os.path.exists(file_path + '.npz'))
+        self._assertEqualClassifiers(classifier, HistogramColorClassifier.loadModel(file_path))
+
+    def test_empty_classifier(self):
+        file_path = os.path.join(self.directory, 'model.npz')
+        for quantize in [False, True]:
+            classifier = HistogramColorClassifier(quantize=quantize)
+            classifier.saveModel(file_path)
+            loaded_classifier = HistogramColorClassifier.loadModel(file_path)
+            self._assertEqualClassifiers(classifier, loaded_classifier)
+            self.assertEqual(loaded_classifier.returnSize(), 0)
+            loaded_classifier.addModelHistogram(self.models[0])
+            self.assertEqual(loaded_classifier.returnBestMatchIndex(self.models[0]), 0)
+
+    def test_name_not_string(self):
+        file_path = os.path.join(self.directory, 'model.npz')
+        classifier = HistogramColorClassifier()
+        classifier.addModelHistogram(self.models[0], name=3)
+        self.assertRaises(ValueError, classifier.saveModel, file_path)
+        self.assertEqual(os.listdir(self.directory), [])
+
+if __name__ == '__main__':
+    unittest.main()